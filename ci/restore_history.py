@@ -1,8 +1,10 @@
-import datetime
 import json
+import os
+import textwrap
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-from botocore.errorfactory import ClientError
+from botocore.config import Config
 
 """
 For the 2022-11-26 run, we switched from .tar.gz to .zip as the primary archive/compression
@@ -33,22 +35,14 @@ From the ci/run_all_spiders.sh script, a single history entry looks like:
 """
 
 
-def object_exists(s3_client, bucket, key):
-    try:
-        s3_client.head_object(Bucket=bucket, Key=key)
-        return True
-    except ClientError:
-        # Not found
-        return False
-
-
-def object_size(s3_client, bucket, key):
-    try:
-        resp = s3_client.head_object(Bucket=bucket, Key=key)
-        return resp["ContentLength"]
-    except ClientError:
-        # Not found
-        return 0
+def list_object_sizes(s3_client, bucket, prefix):
+    """
+    List every object under prefix in one recursive listing, so existence and size
+    checks can be answered locally instead of with a HEAD request per key.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000})
+    return {obj["Key"]: obj["Size"] for page in pages for obj in page.get("Contents", [])}
 
 
 def get_object(s3_client, bucket, key):
@@ -56,15 +50,32 @@ def get_object(s3_client, bucket, key):
     return resp["Body"]
 
 
+def load_run_totals(s3_client, bucket, key):
+    """
+    Reduce a run's stats/_results.json to (spider count, total lines) so that
+    pending results don't each hold a full stats document in memory.
+    """
+    try:
+        stats = json.load(get_object(s3_client, bucket, key))
+    except json.decoder.JSONDecodeError:
+        print(f"Couldn't decode {key}, skipping")
+        return None
+    return stats["count"], sum(s["features"] for s in stats["results"])
+
+
 if __name__ == "__main__":
     bucket_name = "alltheplaces.openaddresses.io"
 
-    history_elements = []
     latest_element = None
 
-    client = boto3.client("s3")
-    paginator = client.get_paginator("list_objects")
-    result = paginator.paginate(Bucket=bucket_name, Prefix="runs/", Delimiter="/")
+    # Size the connection pool to match the stats download workers below
+    config = Config(max_pool_connections=32, retries={"max_attempts": 3, "mode": "adaptive"})
+    client = boto3.client("s3", config=config)
+    existing_keys = list_object_sizes(client, bucket_name, "runs/")
+
+    paginator = client.get_paginator("list_objects_v2")
+    result = paginator.paginate(Bucket=bucket_name, Prefix="runs/", Delimiter="/", PaginationConfig={"PageSize": 1000})
+    run_ids = []
     for prefix in result.search("CommonPrefixes"):
         run_id_prefix = prefix.get("Prefix")
         run_id = run_id_prefix[5:-1]
@@ -72,54 +83,71 @@ if __name__ == "__main__":
         if run_id == "latest":
             continue
 
-        run_data = {
-            "run_id": run_id,
-        }
-
-        stats_suffix = f"runs/{run_id}/stats/_results.json"
-        if object_exists(client, bucket_name, stats_suffix):
-            run_data["stats_url"] = f"https://data.alltheplaces.xyz/{stats_suffix}"
-
-            try:
-                if stats_json := get_object(client, bucket_name, stats_suffix):
-                    stats = json.load(stats_json)
-                    run_data["spiders"] = stats["count"]
-                    run_data["total_lines"] = sum(s["features"] for s in stats["results"])
-            except json.decoder.JSONDecodeError:
-                print(f"Couldn't decode {stats_json}, skipping")
-
-        insights_suffix = f"runs/{run_id}/stats/_insights.json"
-        if object_exists(client, bucket_name, insights_suffix):
-            run_data["insights_url"] = f"https://data.alltheplaces.xyz/{insights_suffix}"
-
-        start_time = datetime.datetime.strptime(run_id, "%Y-%m-%d-%H-%M-%S")
-        run_data["start_time"] = start_time.strftime("%Y-%m-%dT%H:%M:%S") + "Z"
-
-        output_suffix_options = [
-            f"runs/{run_id}/output.tar.gz",
-            f"runs/{run_id}/output.zip",
-            f"runs/{run_id}/output.geojson.gz",
-        ]
-
-        for output_suffix in output_suffix_options:
-            print(f"Trying output suffix {output_suffix}")
-            if size_bytes := object_size(client, bucket_name, output_suffix):
-                print(f" ... found size {size_bytes}")
-                run_data["size_bytes"] = size_bytes
-                run_data["output_url"] = f"https://data.alltheplaces.xyz/{output_suffix}"
-                break
-
-        latest_element = run_data
-        history_elements.append(run_data)
-        print(f"Processing run ID {run_id}")
-
-    # print(json.dumps(history_elements))
-    print("Writing latest.json")
-    with open("latest.json", "w") as f:
-        json.dump(latest_element, f, separators=(",", ":"), indent=2)
+        run_ids.append(run_id)
 
     print("Writing history.json")
-    with open("history.json", "w") as f:
-        json.dump(history_elements, f, separators=(",", ":"), indent=2)
+    # Write to a temporary file alongside history.json so a failed run can't leave it truncated
+    with ThreadPoolExecutor(max_workers=32) as executor, open("history.json.tmp", "w") as history_file:
+        # Fetch the stats files concurrently, results are consumed in run order below
+        stats_futures = {}
+        for run_id in run_ids:
+            stats_suffix = f"runs/{run_id}/stats/_results.json"
+            if stats_suffix in existing_keys:
+                stats_futures[run_id] = executor.submit(load_run_totals, client, bucket_name, stats_suffix)
+
+        try:
+            # Stream each history entry out as it is built rather than holding them all in memory,
+            # matching the layout of json.dumps(..., separators=(",", ":"), indent=2) on the whole list
+            history_file.write("[")
+            for run_id in run_ids:
+                run_data = {
+                    "run_id": run_id,
+                }
+
+                stats_suffix = f"runs/{run_id}/stats/_results.json"
+                if stats_suffix in existing_keys:
+                    run_data["stats_url"] = f"https://data.alltheplaces.xyz/{stats_suffix}"
+
+                    if totals := stats_futures.pop(run_id).result():
+                        run_data["spiders"], run_data["total_lines"] = totals
+
+                insights_suffix = f"runs/{run_id}/stats/_insights.json"
+                if insights_suffix in existing_keys:
+                    run_data["insights_url"] = f"https://data.alltheplaces.xyz/{insights_suffix}"
+
+                # run_id is formatted as %Y-%m-%d-%H-%M-%S
+                run_data["start_time"] = f"{run_id[0:10]}T{run_id[11:13]}:{run_id[14:16]}:{run_id[17:19]}Z"
+
+                output_suffix_options = [
+                    f"runs/{run_id}/output.tar.gz",
+                    f"runs/{run_id}/output.zip",
+                    f"runs/{run_id}/output.geojson.gz",
+                ]
+
+                for output_suffix in output_suffix_options:
+                    print(f"Trying output suffix {output_suffix}")
+                    if size_bytes := existing_keys.get(output_suffix, 0):
+                        print(f" ... found size {size_bytes}")
+                        run_data["size_bytes"] = size_bytes
+                        run_data["output_url"] = f"https://data.alltheplaces.xyz/{output_suffix}"
+                        break
+
+                if latest_element is not None:
+                    history_file.write(",")
+                history_file.write("\n" + textwrap.indent(json.dumps(run_data, separators=(",", ":"), indent=2), "  "))
+                latest_element = run_data
+                print(f"Processing run ID {run_id}")
+        except BaseException:
+            # Don't wait for every queued download to finish before the error surfaces
+            executor.shutdown(cancel_futures=True)
+            raise
+
+        history_file.write("\n]" if latest_element is not None else "]")
+
+    os.replace("history.json.tmp", "history.json")
+
+    print("Writing latest.json")
+    with open("latest.json", "w") as f:
+        f.write(json.dumps(latest_element, separators=(",", ":"), indent=2))
 
     print("Done")